@@ -0,0 +1,141 @@
+# _cache.py
+# Persistent on-disk cache of AI categorizations, shared across runs, and of
+# the Batch API jobs still in flight
+
+import atexit
+import hashlib
+import json
+import sqlite3
+import unicodedata
+
+import pandas as pd
+
+CACHE_PATH = 'ai_cache.sqlite'
+
+# Writes are buffered and committed together, so a run pays one fsync per batch
+# instead of one per categorization
+COMMIT_BATCH_SIZE = 200
+
+# SQLite caps the number of bound parameters per statement
+_QUERY_CHUNK = 900
+
+_conn = sqlite3.connect(CACHE_PATH)
+_conn.execute(
+    'CREATE TABLE IF NOT EXISTS categorizations '
+    '(key TEXT PRIMARY KEY, norm_desc TEXT, category TEXT, subcategory TEXT)'
+)
+_conn.execute(
+    'CREATE TABLE IF NOT EXISTS pending_batches (batch_id TEXT PRIMARY KEY, descriptions TEXT)'
+)
+
+# Results stored since the last commit: {key: (norm_desc, category, subcategory)}
+_pending = {}
+
+
+def normalize_description(description):
+    """NFC-normalized, lowercased, whitespace-collapsed description."""
+    return ' '.join(unicodedata.normalize('NFC', str(description)).lower().split())
+
+
+def cache_key(description):
+    """Cache key for a description: sha1 of its normalized form."""
+    return hashlib.sha1(normalize_description(description).encode('utf-8')).hexdigest()
+
+
+def lookup(descriptions):
+    """
+    Looks up many descriptions at once.
+    Returns a {description: result} dict containing only the cache hits.
+    """
+    key_to_descs = {}
+    for desc in descriptions:
+        if desc and not pd.isna(desc):
+            key_to_descs.setdefault(cache_key(desc), []).append(desc)
+
+    hits = {}
+    keys = []
+    for key, descs in key_to_descs.items():
+        if key in _pending:
+            _, category, subcategory = _pending[key]
+            for desc in descs:
+                hits[desc] = {"category": category, "subcategory": subcategory}
+        else:
+            keys.append(key)
+
+    for start in range(0, len(keys), _QUERY_CHUNK):
+        chunk = keys[start:start + _QUERY_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        rows = _conn.execute(
+            f'SELECT key, category, subcategory FROM categorizations WHERE key IN ({placeholders})',
+            chunk,
+        )
+        for key, category, subcategory in rows:
+            for desc in key_to_descs[key]:
+                hits[desc] = {"category": category, "subcategory": subcategory}
+    return hits
+
+
+def store(mappings):
+    """
+    Buffers {description: result} pairs for the cache, skipping failed categorizations.
+    The buffer is committed once it reaches COMMIT_BATCH_SIZE entries, and at exit.
+    """
+    for desc, result in mappings.items():
+        if desc and not pd.isna(desc) \
+                and isinstance(result, dict) and result.get('category') not in (None, 'Uncategorized'):
+            _pending[cache_key(desc)] = (
+                normalize_description(desc), result.get('category'), result.get('subcategory', '')
+            )
+    if len(_pending) >= COMMIT_BATCH_SIZE:
+        flush()
+
+
+def flush():
+    """Commits all buffered results in a single transaction."""
+    if not _pending:
+        return
+    rows = [(key, *entry) for key, entry in _pending.items()]
+    with _conn:
+        _conn.executemany(
+            'INSERT OR REPLACE INTO categorizations (key, norm_desc, category, subcategory) VALUES (?, ?, ?, ?)',
+            rows,
+        )
+    _pending.clear()
+
+
+def training_rows():
+    """All cached (normalized description, category) pairs, e.g. to train a local classifier."""
+    flush()
+    return _conn.execute(
+        'SELECT norm_desc, category FROM categorizations WHERE norm_desc IS NOT NULL'
+    ).fetchall()
+
+
+def add_pending_batch(batch_id, descriptions):
+    """
+    Records a submitted Batch API job with its descriptions in request order,
+    so a later run can still collect it if this one stops first.
+    Committed right away, unlike the buffered categorizations.
+    """
+    with _conn:
+        _conn.execute(
+            'INSERT OR REPLACE INTO pending_batches (batch_id, descriptions) VALUES (?, ?)',
+            (batch_id, json.dumps(list(descriptions), ensure_ascii=False)),
+        )
+
+
+def pending_batches():
+    """[(batch_id, descriptions)] of every recorded batch that has not been collected yet."""
+    return [
+        (batch_id, json.loads(descriptions))
+        for batch_id, descriptions in _conn.execute('SELECT batch_id, descriptions FROM pending_batches')
+    ]
+
+
+def forget_pending_batch(batch_id):
+    """Drops a batch whose results have been collected."""
+    with _conn:
+        _conn.execute('DELETE FROM pending_batches WHERE batch_id = ?', (batch_id,))
+
+
+atexit.register(flush)
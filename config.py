@@ -11,6 +11,9 @@ INTERNAL_ACCOUNTS = [
     'GE83TB7398736010100052', # BORIS TBC
 ]
 
+# Hashed lookup of the internal accounts for vectorized isin checks
+INTERNAL_ACCOUNTS_SET = frozenset(INTERNAL_ACCOUNTS)
+
 # UPDATED Configuration with sheet name, start row, column letter mappings, and source account mapping
 FILE_CONFIGS = {
     'GIRCHI TBC GEL': {
@@ -67,6 +70,13 @@ FILE_CONFIGS = {
     },
 }
 
+# The only categories the AI may assign (listed in the system prompt in map_transactions.py)
+ALLOWED_CATEGORIES = [
+    'შემოწირულობა', 'ბთ', 'საპარლამენტო დაფინანსება', 'მერჩი', 'რეკლამიდან', 'ტელევიზია',
+    'კომუნალური', 'სამეურნეო', 'მერჩი ყიდვა', 'გატანილი თანხა', 'ხელფასი', 'ხელფასი TV',
+    'დაზღვევა', 'მივლინება', 'იჯარა', 'Facebook', 'ჯედების', 'სხვა', 'სკოლა',
+]
+
 # The final column order for the output Excel file
 FINAL_COLUMNS = [
     'A) Source File', 'B) Date', 'C) Currency', 'D) Mapped Description', 'E) Sub-description',
@@ -1,35 +1,32 @@
 # main.py
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 from dotenv import load_dotenv
-import openai # CORRECT: Import the openai library
-# REMOVED: import google.generativeai as genai
+import openai
 
 import config
-from process_files import process_statement
+from process_files import process_statement, write_excel
 from map_transactions import (
-    get_ai_categorization,
+    get_ai_categorizations,
     map_internal_transfers,
-    apply_bt_specific_rules,
     apply_gatanili_tanxa_restrictions,
-    apply_beta_girchi_rule,
-    apply_rezervis_tanxa_rule,
-    apply_kkk_salary_rule,
-    apply_sakomis_commission_rule,
-    apply_facebook_ads_rule,
-    apply_konvertacia_rule,
-    apply_server_services_rule,
-    apply_sapensio_salary_rule,
-    apply_montajis_safasuri_rule,
-    apply_merchi_keyword_rule,
-    apply_dazgveva_rule,
-    apply_mevafinansebbts_rule,
-    apply_utility_companies_rule,
-    apply_specific_people_gatanili_rule,
-    apply_salary_name_mapping_rule,
+    apply_pre_ai_rules,
+    add_lowered_columns,
+    to_categorical_columns,
+    LOWERED_COLUMNS,
 )
 
+def exit_on_file_error(filename, e):
+    """Reports a statement file that failed to process and stops the run (fail-fast)."""
+    print("\n" + "="*50)
+    print(f"FATAL ERROR: Failed to process file: {filename}")
+    print(f"Reason: {e}")
+    print("The script will now terminate. Please fix the source file or the configuration in config.py.")
+    print("="*50 + "\n")
+    sys.exit(1) # Stop execution
+
 def main():
     # 1. Setup
     load_dotenv()
@@ -48,88 +45,66 @@ def main():
     all_dfs = []
     statement_files = [f for f in os.listdir(input_dir) if f.endswith('.xlsx') or f.endswith('.xls')]
 
+    # Identify file type based on consistent naming
+    matched_files = []
     for filename in statement_files:
-        filepath = os.path.join(input_dir, filename)
-
-        # Identify file type based on consistent naming
         file_key = os.path.splitext(filename)[0] # e.g., "GIRCHI TBC GEL"
-
         if file_key in config.FILE_CONFIGS:
+            matched_files.append((filename, file_key))
+        else:
+            print(f"Warning: No config found for file '{filename}'. Skipping.")
+
+    # Each workbook is parsed in its own process; Excel parsing and the per-file pandas work hold the GIL.
+    # No more workers than files, and no pool at all for a single file.
+    results = {}
+    max_workers = min(len(matched_files), os.cpu_count() or 1)
+    if max_workers <= 1:
+        for filename, file_key in matched_files:
             print(f"Processing {filename}...")
+            filepath = os.path.join(input_dir, filename)
             try:
-                # This is the critical block for error handling
-                df = process_statement(filepath, config.FILE_CONFIGS[file_key])
-                if not df.empty:
-                    all_dfs.append(df)
+                results[filename] = process_statement(filepath, config.FILE_CONFIGS[file_key])
             except Exception as e:
-                print("\n" + "="*50)
-                print(f"FATAL ERROR: Failed to process file: {filename}")
-                print(f"Reason: {e}")
-                print("The script will now terminate. Please fix the source file or the configuration in config.py.")
-                print("="*50 + "\n")
-                sys.exit(1) # Stop execution
-        else:
-            print(f"Warning: No config found for file '{filename}'. Skipping.")
+                exit_on_file_error(filename, e)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for filename, file_key in matched_files:
+                print(f"Processing {filename}...")
+                filepath = os.path.join(input_dir, filename)
+                futures[executor.submit(process_statement, filepath, config.FILE_CONFIGS[file_key])] = filename
+
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    results[filename] = future.result()
+                except Exception as e:
+                    executor.shutdown(cancel_futures=True)
+                    exit_on_file_error(filename, e)
+
+    # Keep the directory listing order regardless of which file finished first
+    for filename, _ in matched_files:
+        if not results[filename].empty:
+            all_dfs.append(results[filename])
 
     if not all_dfs:
         print("No files were successfully processed. Exiting.")
         return
 
     # 3. Consolidate, Categorize, and Map
+    # Text columns already come out of process_statement() as string dtype, which concat keeps
     master_df = pd.concat(all_dfs, ignore_index=True)
+    # Lowercase the searched text columns once for all keyword rules
+    master_df = add_lowered_columns(master_df)
 
-    print("Mapping internal transfers and categorizing as კონვერტაცია...")
-    master_df = map_internal_transfers(master_df, config.INTERNAL_ACCOUNTS)
+    print("Mapping internal transfers...")
+    master_df = map_internal_transfers(master_df, config.INTERNAL_ACCOUNTS_SET)
 
     print("Applying regex-based categorization rules first...")
-
-    print("Applying BT-specific categorization rules...")
-    master_df = apply_bt_specific_rules(master_df)
-
-    print("Applying beta.girchi donation rules...")
-    master_df = apply_beta_girchi_rule(master_df)
-
-    print("Applying specific-person name mapping to გატანილი თანხა...")
-    master_df = apply_specific_people_gatanili_rule(master_df)
-
-    print("Applying salary name mapping to ხელფასი...")
-    master_df = apply_salary_name_mapping_rule(master_df)
-
-    print("Applying რეზერვის თანხა donation rules...")
-    master_df = apply_rezervis_tanxa_rule(master_df)
-
-    print("Applying კკკ salary rules...")
-    master_df = apply_kkk_salary_rule(master_df)
-
-    print("Applying საკომის commission rules...")
-    master_df = apply_sakomis_commission_rule(master_df)
-
-    print("Applying FACEBK ads rules...")
-    master_df = apply_facebook_ads_rule(master_df)
-
-    print("Applying კონვერტაცია keyword rules...")
-    master_df = apply_konvertacia_rule(master_df)
-
-    print("Applying server/digital services rules...")
-    master_df = apply_server_services_rule(master_df)
-
-    print("Applying საპენსიო salary rules...")
-    master_df = apply_sapensio_salary_rule(master_df)
-
-    print("Applying მონტაჟის საფასური salary rules...")
-    master_df = apply_montajis_safasuri_rule(master_df)
-
-    print("Applying მერჩი keyword rules...")
-    master_df = apply_merchi_keyword_rule(master_df)
-
-    print("Applying დაზღვ insurance rules...")
-    master_df = apply_dazgveva_rule(master_df)
-
-    print("Applying mevafinansebbts donation rules...")
-    master_df = apply_mevafinansebbts_rule(master_df)
-
-    print("Applying utility companies rules...")
-    master_df = apply_utility_companies_rule(master_df)
+    print("Applying internal transfer (კონვერტაცია), BT-specific and keyword rules (single pass)...")
+    master_df = apply_pre_ai_rules(master_df, config.INTERNAL_ACCOUNTS_SET)
+    # One defragmenting copy after the rule phase
+    master_df = master_df.copy()
 
     print("Starting AI categorization for remaining transactions... this may take a while.")
     # Only categorize transactions that haven't been categorized yet (after all regex rules)
@@ -138,17 +113,29 @@ def main():
         if 'D) Mapped Description' in master_df.columns
         else pd.Series(True, index=master_df.index)
     )
-    unique_descriptions = master_df[uncategorized_mask]['Original Description'].dropna().unique()
-    ai_mappings = {desc: get_ai_categorization(desc) for desc in unique_descriptions}
+    # Slice only the description column once; it feeds both the AI request and the write-back
+    uncategorized_desc = master_df.loc[uncategorized_mask, 'Original Description']
+    unique_descriptions = uncategorized_desc.dropna().unique()
+    # Large non-interactive runs can go through the cheaper Batch API by setting AI_BATCH_THRESHOLD;
+    # AI_LOCAL_CONFIDENCE lets a local classifier answer the descriptions it is that sure about
+    batch_threshold = os.getenv("AI_BATCH_THRESHOLD")
+    local_confidence = os.getenv("AI_LOCAL_CONFIDENCE")
+    ai_mappings = get_ai_categorizations(
+        unique_descriptions,
+        batch_threshold=int(batch_threshold) if batch_threshold else None,
+        local_confidence=float(local_confidence) if local_confidence else None,
+    )
 
-    master_df['ai_map'] = master_df['Original Description'].map(ai_mappings)
+    cat_map = {desc: result.get('category') for desc, result in ai_mappings.items()}
+    sub_map = {desc: result.get('subcategory') for desc, result in ai_mappings.items()}
     # Only apply AI categorization to uncategorized transactions
-    master_df.loc[uncategorized_mask, 'D) Mapped Description'] = master_df.loc[uncategorized_mask, 'ai_map'].apply(lambda x: x.get('category') if isinstance(x, dict) else 'Uncategorized')
-    master_df.loc[uncategorized_mask, 'E) Sub-description'] = master_df.loc[uncategorized_mask, 'ai_map'].apply(lambda x: x.get('subcategory') if isinstance(x, dict) else '')
+    master_df.loc[uncategorized_mask, 'D) Mapped Description'] = uncategorized_desc.map(cat_map).fillna('Uncategorized')
+    master_df.loc[uncategorized_mask, 'E) Sub-description'] = uncategorized_desc.map(sub_map).fillna('')
 
     print("Applying გატანილი თანხა restriction rules...")
     master_df = apply_gatanili_tanxa_restrictions(master_df)
-    # The rest of the file remains the same...
+    master_df.drop(columns=list(LOWERED_COLUMNS.values()), errors='ignore', inplace=True)
+    master_df = to_categorical_columns(master_df)
     master_df.rename(columns={'Source File': 'A) Source File', 'Date': 'B) Date', 'Original Description': 'F) Original Description', 'Paid Out': 'H) Paid Out', 'Paid In': 'I) Paid In', 'Balance': 'J) Balance', 'Partner Name': 'K) Partner Name', 'Partner Account': 'N) Partner Account'}, inplace=True)
 
     # 4. Finalize and Save
@@ -160,7 +147,7 @@ def main():
             final_df[col] = None # Ensure all columns from config are present
 
     output_path = os.path.join(output_dir, 'Main_File.xlsx')
-    final_df.to_excel(output_path, index=False)
+    write_excel(final_df, output_path)
 
     print(f"\nSuccess! Processed {len(all_dfs)} files.")
     print(f"Final consolidated file saved to: {output_path}")
@@ -1,20 +1,48 @@
 # map_transactions.py
 # UPDATED to use the OpenAI API for transaction categorization
 
+import asyncio
+import functools
 import openai
 import json
+import numpy as np
 import pandas as pd
+import random
 import re
-
-def get_ai_categorization(description): # client parameter is no longer used but we keep it for compatibility with main.py
-    if not description or pd.isna(description):
-        return {"category": "Uncategorized", "subcategory": ""}
-
-    # The prompt is now structured for OpenAI's Chat model with strict category enforcement
-    system_prompt = """You are a Georgian bank transaction categorization expert. You must categorize transactions using ONLY the predefined categories below. NEVER create new categories or use variations.
+import time
+
+import _cache
+import config
+
+try:
+    import hyperscan  # Optional: single-pass multi-pattern keyword matching
+except ImportError:
+    hyperscan = None
+
+try:
+    # Optional: local classifier answering confident descriptions without an API call
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import Pipeline
+except ImportError:
+    Pipeline = None
+
+try:
+    import pyarrow as pa  # Optional: Arrow compute kernels for the keyword scan
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+try:
+    import re2  # Optional: linear-time multi-pattern matching (google-re2) without Hyperscan
+except ImportError:
+    re2 = None
+
+# The prompt is structured for OpenAI's Chat model with strict category enforcement
+SYSTEM_PROMPT = """You are a Georgian bank transaction categorization expert. You must categorize transactions using ONLY the predefined categories below. NEVER create new categories or use variations.
 
 ALLOWED CATEGORIES (choose EXACTLY one):
-შემოწირულობა, ბთ, საპარლამენტო დაფინანსება, მერჩი, რეკლამიდან, ტელევიზია, კომუნალური, სამეურნეო, მერჩი ყიდვა, გატანილი თანხა, ხელფასი, ხელფასი TV, დაზღვევა, მივლინება, იჯარა, Facebook, ჯედების, სხვა, სკოლა
+""" + ', '.join(config.ALLOWED_CATEGORIES) + """
 
 STRICT RULES:
 1. Use EXACTLY one category from the list above - character-for-character match
@@ -32,58 +60,419 @@ Examples of good responses:
 
 Analyze this transaction description and return the appropriate category:"""
 
+# Chat model used for categorization. Sampling is fixed at temperature 0 so a
+# description always gets the same answer, which is what the cache stores.
+# SYSTEM_PROMPT is sent unchanged as the first message of every request, so
+# OpenAI's automatic prompt caching can reuse it as a shared prefix.
+AI_MODEL = "gpt-4o-mini"
+AI_TEMPERATURE = 0
+
+# Structured output: the model can only return a category from config.ALLOWED_CATEGORIES.
+# Strict mode requires every property to be listed as required.
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "transaction_category",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "category": {"type": "string", "enum": list(config.ALLOWED_CATEGORIES)},
+                "subcategory": {"type": "string"},
+            },
+            "required": ["category", "subcategory"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Maximum number of categorization requests kept in flight at once
+AI_CONCURRENCY = 32
+
+# Rate-limited requests are retried up to AI_MAX_RETRIES times, waiting
+# AI_RETRY_BASE_DELAY * 2**attempt seconds (plus jitter) between attempts
+AI_MAX_RETRIES = 5
+AI_RETRY_BASE_DELAY = 1.0
+
+# The local classifier is only trained once the cache holds this many labelled descriptions
+LOCAL_CLASSIFIER_MIN_ROWS = 200
+
+# Seconds between status checks of a submitted Batch API job
+BATCH_POLL_INTERVAL = 30
+
+# Per-file Batch API limits: at most 50,000 requests and 200 MB of input.
+# Larger runs are split into several batches; the byte cap leaves some headroom.
+BATCH_MAX_REQUESTS = 50_000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+
+def _build_messages(description):
+    """Builds the chat messages for a single transaction description."""
     user_prompt = f"Please categorize this transaction: '{description}'"
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def _completion_params(description):
+    """Chat completion parameters for one description, shared by the direct and batch calls."""
+    return {
+        "model": AI_MODEL,
+        "messages": _build_messages(description),
+        "temperature": AI_TEMPERATURE,
+        "response_format": RESPONSE_FORMAT,
+    }
+
+
+def _parse_categorization(content):
+    """
+    Parses the model's JSON reply. With RESPONSE_FORMAT the reply always matches
+    the schema; the guards remain for the legacy SDK path, which sends no schema,
+    and for refusals, whose content is empty.
+    A category outside config.ALLOWED_CATEGORIES is replaced by "სხვა".
+    """
+    try:
+        result = json.loads(content)
+    except Exception:
+        return {"category": "Uncategorized", "subcategory": ""}
+    if not isinstance(result, dict):
+        return {"category": "Uncategorized", "subcategory": ""}
+
+    if result.get('category') not in config.ALLOWED_CATEGORIES:
+        return {"category": "სხვა", "subcategory": result.get('subcategory', '')}
+    return result
+
+
+def get_ai_categorization(description):
+    if not description or pd.isna(description):
+        return {"category": "Uncategorized", "subcategory": ""}
+
+    cached = _cache.lookup([description])
+    if description in cached:
+        return cached[description]
 
     # Call OpenAI with v1 client if available; fallback to legacy style.
     try:
         from openai import OpenAI  # type: ignore
         client = OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-            response_format={"type": "json_object"},
-        )
+        response = client.chat.completions.create(**_completion_params(description))
         content = response.choices[0].message.content
     except Exception:
         # Legacy SDK fallback
         response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
+            model=AI_MODEL,
+            messages=_build_messages(description),
+            temperature=AI_TEMPERATURE,
         )
         content = response["choices"][0]["message"]["content"]
 
-    # Parse JSON content; guard against invalid JSON
-    try:
-        return json.loads(content)
-    except Exception:
-        return {"category": "Uncategorized", "subcategory": ""}
-
+    result = _parse_categorization(content)
+    _cache.store({description: result})
+    return result
 
 
-def apply_bt_specific_rules(df):
+async def _categorize_one(client, semaphore, description):
     """
-    Apply BT-specific business rules for categorization.
+    Categorizes one description, waiting for a free slot in the semaphore.
+    Retries with exponential backoff when the API answers with a rate limit error.
+    An exhausted quota is not retried and stops the run, since every other
+    request would fail the same way. Any other API error, or running out of
+    retries, gives Uncategorized for this description only, so the other
+    answers of the run are still cached.
+    """
+    if not description or pd.isna(description):
+        return {"category": "Uncategorized", "subcategory": ""}
+
+    async with semaphore:
+        for attempt in range(AI_MAX_RETRIES + 1):
+            try:
+                response = await client.chat.completions.create(**_completion_params(description))
+                break
+            except openai.RateLimitError as e:
+                if getattr(e, 'code', None) == 'insufficient_quota':
+                    raise
+                if attempt == AI_MAX_RETRIES:
+                    print(f"Warning: AI categorization failed for '{description}': {e}")
+                    return {"category": "Uncategorized", "subcategory": ""}
+                # Keep the slot while backing off so the other requests slow down too
+                await asyncio.sleep(AI_RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, AI_RETRY_BASE_DELAY))
+            except openai.APIError as e:
+                print(f"Warning: AI categorization failed for '{description}': {e}")
+                return {"category": "Uncategorized", "subcategory": ""}
+    return _parse_categorization(response.choices[0].message.content)
+
+
+async def _gather_categorizations(descriptions, concurrency=AI_CONCURRENCY):
+    """Dispatches all categorization requests concurrently, bounded by `concurrency`."""
+    from openai import AsyncOpenAI  # type: ignore
+    semaphore = asyncio.Semaphore(concurrency)
+    # Rate-limit retries are handled by _categorize_one(); the client's own retries would stack on top
+    async with AsyncOpenAI(max_retries=0) as client:
+        results = await asyncio.gather(
+            *[_categorize_one(client, semaphore, desc) for desc in descriptions]
+        )
+    return dict(zip(descriptions, results))
+
+
+def _batch_request_line(custom_id, description):
+    """One JSONL line of a Batch API input file, UTF-8 encoded."""
+    return json.dumps({
+        "custom_id": str(custom_id),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": _completion_params(description),
+    }, ensure_ascii=False).encode('utf-8')
+
+
+def _batch_chunks(descriptions):
+    """
+    Splits descriptions into [(descriptions, request lines)] chunks that each
+    fit a single Batch API input file. Custom ids are positions within the chunk.
+    """
+    chunks = []
+    chunk_descs, chunk_lines, chunk_bytes = [], [], 0
+    for desc in descriptions:
+        line = _batch_request_line(len(chunk_lines), desc)
+        if chunk_lines and (len(chunk_lines) == BATCH_MAX_REQUESTS
+                            or chunk_bytes + len(line) + 1 > BATCH_MAX_BYTES):
+            chunks.append((chunk_descs, chunk_lines))
+            chunk_descs, chunk_lines, chunk_bytes = [], [], 0
+            line = _batch_request_line(0, desc)
+        chunk_descs.append(desc)
+        chunk_lines.append(line)
+        chunk_bytes += len(line) + 1
+    if chunk_lines:
+        chunks.append((chunk_descs, chunk_lines))
+    return chunks
+
+
+def _stream_batch_file(client, file_id):
+    """Yields the JSON records of a batch output or error file, one line at a time."""
+    with client.files.with_streaming_response.content(file_id) as content:
+        for line in content.iter_lines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def _collect_batch(client, batch_id, descriptions, poll_interval=BATCH_POLL_INTERVAL):
+    """
+    Waits for a submitted batch to finish and returns its results in request order.
+    Failed requests, or all of them when the batch produced no output, come back
+    as Uncategorized. Successful answers are cached before the batch is forgotten,
+    so a run that stops after this point does not pay for them twice.
+    """
+    batch = client.batches.retrieve(batch_id)
+    while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch_id)
+
+    # Stream the output file line by line, so memory stays flat however large the batch is
+    results = np.empty(len(descriptions), dtype=object)
+    if batch.output_file_id:
+        for record in _stream_batch_file(client, batch.output_file_id):
+            response = record.get('response') or {}
+            if response.get('status_code') != 200:
+                continue
+            content = response['body']['choices'][0]['message']['content']
+            results[int(record['custom_id'])] = _parse_categorization(content)
+
+    failed = sum(result is None for result in results)
+    if failed:
+        reason = f"status '{batch.status}'"
+        if batch.error_file_id:
+            for record in _stream_batch_file(client, batch.error_file_id):
+                response = record.get('response') or {}
+                error = (response.get('body') or {}).get('error') or record.get('error') or {}
+                reason = error.get('message', reason)
+                break
+        elif batch.errors and batch.errors.data:
+            reason = batch.errors.data[0].message
+        print(f"Warning: {failed} of {len(descriptions)} requests of batch {batch_id} failed ({reason}); "
+              "they are left Uncategorized")
+
+    results = [
+        result if result is not None else {"category": "Uncategorized", "subcategory": ""}
+        for result in results
+    ]
+    _cache.store(dict(zip(descriptions, results)))
+    _cache.flush()
+    _cache.forget_pending_batch(batch_id)
+    return results
+
+
+def resume_pending_batches(poll_interval=BATCH_POLL_INTERVAL):
+    """
+    Collects the batches an earlier run submitted but stopped waiting for,
+    caching their answers. Batches the API no longer knows are dropped.
+    """
+    pending = _cache.pending_batches()
+    if not pending:
+        return
+    from openai import OpenAI  # type: ignore
+    client = OpenAI()
+    for batch_id, descriptions in pending:
+        print(f"Resuming batch {batch_id} with {len(descriptions)} requests from an earlier run...")
+        try:
+            _collect_batch(client, batch_id, descriptions, poll_interval)
+        except openai.NotFoundError:
+            print(f"Warning: batch {batch_id} no longer exists, dropping it")
+            _cache.forget_pending_batch(batch_id)
+
+
+def categorize_batch(descriptions, poll_interval=BATCH_POLL_INTERVAL):
+    """
+    Categorizes descriptions through the OpenAI Batch API (half the per-token
+    price of direct calls, completion window up to 24h).
+    Uploads one JSONL request per description, split into as many batches as the
+    per-file limits require (BATCH_MAX_REQUESTS, BATCH_MAX_BYTES), waits for them
+    to finish and returns the results in input order. Requests that failed come
+    back as Uncategorized.
+    Every batch is recorded in the cache until collected, so if the run stops
+    while waiting, the next one picks it up (see resume_pending_batches()).
+    """
+    from openai import OpenAI  # type: ignore
+    client = OpenAI()
+
+    submitted = []
+    for chunk_descs, chunk_lines in _batch_chunks(descriptions):
+        batch_input = client.files.create(
+            file=('categorizations.jsonl', b'\n'.join(chunk_lines)),
+            purpose="batch",
+        )
+        batch = client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        _cache.add_pending_batch(batch.id, chunk_descs)
+        submitted.append((batch.id, chunk_descs))
+        print(f"Submitted batch {batch.id} with {len(chunk_descs)} requests")
+    print("Waiting for the batches to complete...")
+
+    results = []
+    for batch_id, chunk_descs in submitted:
+        results.extend(_collect_batch(client, batch_id, chunk_descs, poll_interval))
+    return results
+
+
+def train_local_classifier():
+    """
+    Fits a character n-gram TF-IDF + logistic regression classifier on the cached
+    AI categorizations. Returns None when scikit-learn is not installed or the
+    cache is too small (fewer than LOCAL_CLASSIFIER_MIN_ROWS rows, or one category).
+    """
+    if Pipeline is None:
+        return None
+    rows = _cache.training_rows()
+    if len(rows) < LOCAL_CLASSIFIER_MIN_ROWS or len({category for _, category in rows}) < 2:
+        return None
+
+    classifier = Pipeline([
+        ('tfidf', TfidfVectorizer(analyzer='char_wb', ngram_range=(2, 4))),
+        ('lr', LogisticRegression(max_iter=1000)),
+    ])
+    classifier.fit([norm for norm, _ in rows], [category for _, category in rows])
+    return classifier
+
+
+def local_categorizations(classifier, descriptions, min_confidence):
+    """
+    Categorizes descriptions with a classifier from train_local_classifier().
+    Returns a {description: result} dict holding only the predictions whose
+    probability is at least `min_confidence`.
+    """
+    if not descriptions:
+        return {}
+    proba = classifier.predict_proba([_cache.normalize_description(desc) for desc in descriptions])
+    best = proba.argmax(axis=1)
+    confident = proba[np.arange(len(best)), best] >= min_confidence
+    classes = classifier.classes_
+    return {
+        desc: {"category": str(classes[label]), "subcategory": "Local classifier"}
+        for desc, label, ok in zip(descriptions, best, confident) if ok
+    }
+
+
+def get_ai_categorizations(descriptions, concurrency=AI_CONCURRENCY, batch_threshold=None, local_confidence=None):
+    """
+    Categorizes many descriptions at once and returns a {description: result} dict.
+    Cached descriptions are answered from disk; the rest are sent concurrently
+    (at most `concurrency` in flight) instead of one round-trip after another,
+    once per normalized description.
+    With `batch_threshold` set, at least that many misses go through the Batch
+    API instead (see categorize_batch()), after collecting any batches an earlier
+    run left pending. With `local_confidence` set, a local
+    classifier trained on the cache answers the misses it predicts with at least
+    that probability (see train_local_classifier()).
+    Falls back to sequential calls on the legacy SDK.
+    """
+    descriptions = list(descriptions)
+    if not descriptions:
+        return {}
+
+    # Batches a stopped run left behind are already paid for; their answers land in the cache
+    if batch_threshold is not None:
+        resume_pending_batches()
+
+    results = _cache.lookup(descriptions)
+    misses = [desc for desc in descriptions if desc not in results]
+    if not misses:
+        return results
+
+    # Descriptions differing only in case or whitespace share a cache key, so
+    # only the first of them is sent and its result is reused for the others
+    keys = [_cache.cache_key(desc) if desc and not pd.isna(desc) else desc for desc in misses]
+    representatives = {}
+    for key, desc in zip(keys, misses):
+        representatives.setdefault(key, desc)
+    to_send = list(representatives.values())
+
+    # Cheap local model first: confident predictions skip the API. They are not
+    # cached, so the classifier is only ever trained on AI answers.
+    local = {}
+    if local_confidence is not None:
+        classifier = train_local_classifier()
+        if classifier is not None:
+            valid = [desc for desc in to_send if desc and not pd.isna(desc)]
+            local = local_categorizations(classifier, valid, local_confidence)
+            to_send = [desc for desc in to_send if desc not in local]
+
+    try:
+        from openai import AsyncOpenAI  # type: ignore # noqa: F401
+    except ImportError:
+        # Legacy SDK has no async client
+        sent = {desc: get_ai_categorization(desc) for desc in to_send}
+    else:
+        if not to_send:
+            sent = {}
+        elif batch_threshold is not None and len(to_send) >= batch_threshold:
+            sent = dict(zip(to_send, categorize_batch(to_send)))
+        else:
+            sent = asyncio.run(_gather_categorizations(to_send, concurrency=concurrency))
+
+    fresh = {desc: sent[representatives[key]] for key, desc in zip(keys, misses) if representatives[key] in sent}
+    _cache.store(fresh)
+    _cache.flush()
+    results.update(fresh)
+    results.update({desc: local[representatives[key]] for key, desc in zip(keys, misses) if representatives[key] in local})
+    return results
+
+
+def bt_specific_rule_masks(df):
+    """
+    BT-specific business rules for categorization.
     If income from BT BOG or BT TBC GEL is exactly 175, 176, or 200 GEL,
     it should be categorized as "ბთ".
     For BT BOG: checks column E (Paid In) for income of 175 GEL specifically.
     For BT TBC GEL: checks all target amounts (175, 176, 200).
     IMPORTANT: Only applies to income transactions (Paid In > 0), not expenses.
+    Returns [(mask, category, subdesc), ...] in priority order; see apply_pre_ai_rules().
     """
     bt_bog_files = ['BT BOG.xlsx']
     bt_tbc_files = ['BT TBC GEL.xlsx']
 
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
-
     # BT BOG specific rule: only 175 GEL income (must be positive income, not expense)
     bt_bog_mask = (
-        uncategorized_mask &
         df['Source File'].isin(bt_bog_files) &
         (df['Paid In'] == 175.0) &
         (df['Paid In'] > 0) &  # Only income transactions
@@ -92,450 +481,537 @@ def apply_bt_specific_rules(df):
 
     # BT TBC GEL rule: 175, 176, or 200 GEL income (must be positive income, not expense)
     bt_tbc_mask = (
-        uncategorized_mask &
         df['Source File'].isin(bt_tbc_files) &
         df['Paid In'].isin([175.0, 176.0, 200.0]) &
         (df['Paid In'] > 0) &  # Only income transactions
         (df['Paid Out'].fillna(0) == 0)  # Not expense transactions
     )
 
-    # Apply the rules
-    df.loc[bt_bog_mask, 'D) Mapped Description'] = 'ბთ'
-    df.loc[bt_bog_mask, 'E) Sub-description'] = 'BT BOG 175 GEL income rule'
-
-    df.loc[bt_tbc_mask, 'D) Mapped Description'] = 'ბთ'
-    df.loc[bt_tbc_mask, 'E) Sub-description'] = 'BT TBC specific amount income rule'
-
-    return df
-
-
-def apply_beta_girchi_rule(df):
-    """
-    Apply beta.girchi detection rule.
-    If "beta.girchi" appears in the transaction description,
-    it should be categorized as "შემოწირულობა".
-    """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
-
-    # Create mask for transactions containing "beta.girchi"
-    beta_girchi_mask = uncategorized_mask & df['Original Description'].str.contains('beta.girchi', case=False, na=False)
-
-    # Apply the rule
-    df.loc[beta_girchi_mask, 'D) Mapped Description'] = 'შემოწირულობა'
-    df.loc[beta_girchi_mask, 'E) Sub-description'] = 'beta.girchi donation rule'
-
-    return df
-
-
-def apply_rezervis_tanxa_rule(df):
-    """
-    Apply რეზერვის თანხა detection rule.
-    If "რეზერვის თანხა" appears in the transaction description,
-    it should be categorized as "შემოწირულობა".
-    """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
+    return [
+        (bt_bog_mask.to_numpy(dtype=bool), 'ბთ', 'BT BOG 175 GEL income rule'),
+        (bt_tbc_mask.to_numpy(dtype=bool), 'ბთ', 'BT TBC specific amount income rule'),
+    ]
 
-    # Create mask for transactions containing "რეზერვის თანხა"
-    rezervis_mask = uncategorized_mask & df['Original Description'].str.contains('რეზერვის თანხა', case=False, na=False)
 
-    # Apply the rule
-    df.loc[rezervis_mask, 'D) Mapped Description'] = 'შემოწირულობა'
-    df.loc[rezervis_mask, 'E) Sub-description'] = 'რეზერვის თანხა donation rule'
+# The only people "გატანილი თანხა" may be assigned to (see apply_gatanili_tanxa_restrictions)
+GATANILI_APPROVED_NAMES = [
+    'ვახტანგი მეგრელიშვილი',
+    'ალექსანდრე რაქვიაშვილი',
+    'იაგო ხვიჩია',
+    'ჰერმან საბო'
+]
 
-    return df
+# Built once; names are lowercased and matched against the lowercased descriptions.
+# Kept as a string: on Arrow columns pandas < 3 hands the pattern to pyarrow, which rejects re.Pattern.
+GATANILI_APPROVED_PATTERN = '|'.join(re.escape(name.lower()) for name in GATANILI_APPROVED_NAMES)
 
 
-def apply_kkk_salary_rule(df):
+def apply_gatanili_tanxa_restrictions(df):
     """
-    Apply კკკ salary detection rule.
-    If "კკკ" appears in the transaction description,
-    it should be categorized as "ხელფასი".
+    Apply restrictions for "გატანილი თანხა" categorization.
+    This category can only be used for transactions to specific approved people:
+    - ვახტანგი მეგრელიშვილი
+    - ალექსანდრე რაქვიაშვილი
+    - იაგო ხვიჩია
+    - ჰერმან საბო
     """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
-
-    # Create mask for transactions containing "კკკ"
-    kkk_mask = uncategorized_mask & df['Original Description'].str.contains('კკკ', case=False, na=False)
-
-    # Apply the rule
-    df.loc[kkk_mask, 'D) Mapped Description'] = 'ხელფასი'
-    df.loc[kkk_mask, 'E) Sub-description'] = 'კკკ salary rule'
+    # Find transactions currently categorized as "გატანილი თანხა"
+    gatanili_mask = df['D) Mapped Description'] == 'გატანილი თანხა'
 
-    return df
+    # Reuse the lowercased description column from add_lowered_columns() when present
+    lc_col = LOWERED_COLUMNS['Original Description']
+    if lc_col in df.columns:
+        lowered = df.loc[gatanili_mask, lc_col]
+    else:
+        lowered = _lowered(df.loc[gatanili_mask, 'Original Description'])
 
+    # Check in one vectorized pass if any approved name appears in the transaction description
+    approved = lowered.str.contains(GATANILI_APPROVED_PATTERN).astype(bool)
 
-def apply_sakomis_commission_rule(df):
-    """
-    Apply საკომის commission detection rule.
-    If "საკომის" appears in the transaction description,
-    it should be categorized as "საკომისიო".
-    """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
-
-    # Create mask for transactions containing "საკომის"
-    sakomis_mask = uncategorized_mask & df['Original Description'].str.contains('საკომის', case=False, na=False)
-
-    # Apply the rule
-    df.loc[sakomis_mask, 'D) Mapped Description'] = 'საკომისიო'
-    df.loc[sakomis_mask, 'E) Sub-description'] = 'საკომის commission rule'
+    # If no approved name found, change category to "სხვა"
+    not_approved_idx = approved.index[~approved]
+    df.loc[not_approved_idx, ['D) Mapped Description', 'E) Sub-description']] = [
+        'სხვა', 'გატანილი თანხა restriction applied'
+    ]
 
     return df
 
 
-def apply_facebook_ads_rule(df):
+def map_internal_transfers(df, internal_accounts_list):
     """
-    Apply Facebook ads detection rule.
-    If "FACEBK" appears in the transaction description,
-    it should be categorized as "რეკლამა".
+    Marks each Partner Account as an Internal Transfer or External account.
+    Transfers where both source and destination accounts are internal are
+    categorized as კონვერტაცია by apply_pre_ai_rules() (see
+    internal_transfer_rule_masks()), without requiring AI categorization.
     """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
+    internal_accounts = frozenset(internal_accounts_list)
 
-    # Create mask for transactions containing "FACEBK"
-    facebook_mask = uncategorized_mask & df['Original Description'].str.contains('FACEBK', case=False, na=False)
+    # Ensure Partner Account and Source Account are strings (skip the copy if they already are)
+    if not pd.api.types.is_string_dtype(df['Partner Account']):
+        df['Partner Account'] = df['Partner Account'].astype(str)
+    if 'Source Account' not in df.columns:
+        df['Source Account'] = ''
+    elif not pd.api.types.is_string_dtype(df['Source Account']):
+        df['Source Account'] = df['Source Account'].astype(str)
 
-    # Apply the rule
-    df.loc[facebook_mask, 'D) Mapped Description'] = 'რეკლამა'
-    df.loc[facebook_mask, 'E) Sub-description'] = 'FACEBK ads rule'
+    # Mark Partner Account as Internal or External
+    partner_internal = df['Partner Account'].isin(internal_accounts).to_numpy(dtype=bool)
+    df['AD) Partner Account Internal Map'] = np.where(partner_internal, 'Internal Transfer', 'External')
 
     return df
 
 
-def apply_konvertacia_rule(df):
+def internal_transfer_rule_masks(df, internal_accounts_list):
     """
-    Apply კონვერტაცია detection rule.
-    If "კონვერტაცია" appears in the transaction description,
-    it should be categorized as "კონვერტაცია".
+    Detects internal-to-internal transfers, which are categorized as კონვერტაცია.
+    Returns [(mask, category, subdesc)]; see apply_pre_ai_rules().
     """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
+    internal_accounts = frozenset(internal_accounts_list)
 
-    # Create mask for transactions containing "კონვერტაცია"
-    konvertacia_mask = uncategorized_mask & df['Original Description'].str.contains('კონვერტაცია', case=False, na=False)
+    # Reuse the partner lookup map_internal_transfers() already stored in the AD column
+    if 'AD) Partner Account Internal Map' in df.columns:
+        partner_internal = (df['AD) Partner Account Internal Map'] == 'Internal Transfer').to_numpy(dtype=bool)
+    else:
+        partner_internal = df['Partner Account'].isin(internal_accounts).to_numpy(dtype=bool)
 
-    # Apply the rule
-    df.loc[konvertacia_mask, 'D) Mapped Description'] = 'კონვერტაცია'
-    df.loc[konvertacia_mask, 'E) Sub-description'] = 'კონვერტაცია keyword rule'
+    # Internal accounts are never NaN or empty, so isin already excludes those
+    internal_transfer_mask = (
+        df['Source Account'].isin(internal_accounts).to_numpy(dtype=bool) &
+        partner_internal &
+        (df['Source Account'] != df['Partner Account']).to_numpy(dtype=bool, na_value=True)  # Exclude same account transfers
+    )
 
+    return [(internal_transfer_mask, 'კონვერტაცია', 'Internal account transfer')]
+
+
+def _keywords(*keywords):
+    """Escapes literal keywords into lowercase regex patterns."""
+    return [re.escape(keyword.lower()) for keyword in keywords]
+
+
+# Keyword categorization rules, in priority order: when several rules match the
+# same transaction, the one listed first wins. Each rule searches the given
+# columns (case-insensitively) for any of its regex patterns. Patterns are
+# matched against lowercased text, so they must be written in lowercase.
+KEYWORD_RULES = [
+    {
+        # "beta.girchi" in the description -> donation
+        'category': 'შემოწირულობა',
+        'subdesc': 'beta.girchi donation rule',
+        'columns': ['Original Description'],
+        'patterns': ['beta.girchi'],
+    },
+    {
+        # Specific people in the description or partner name -> withdrawn money
+        'category': 'გატანილი თანხა',
+        'subdesc': 'Name-based mapping rule',
+        'columns': ['Original Description', 'Partner Name'],
+        'patterns': _keywords('რაქვიაშვილი', 'მეგრელიშვილი', 'ჰერმან', 'იაგო ხვიჩია', 'ნარტყოშვილი'),
+    },
+    {
+        # Salaried people in the description or partner name -> salary
+        'category': 'ხელფასი',
+        'subdesc': 'Salary name mapping rule',
+        'columns': ['Original Description', 'Partner Name'],
+        'patterns': _keywords(
+            'ლევან ჯგერენაია',
+            'ნუგზარ ტაბატაძე',
+            'რევაზი სუთიძე',
+            'მაყვალა გიორგაძე',
+            'იზა ნადარეიშვილი',
+            'მარიკა ვერულიძე',
+            'ლიზი შეწირული',
+            'გიორგი პაჭიკაშვილი',
+            'ვაკო თენეიშვილი',
+            'თედო ჯაბუა',
+            'ანა ნოდია',
+            'გიორგი სოლოღაშვილი',
+            'რუსუდანი აბუაშვილი',
+            'სიმონ ღარიბაშვილი',
+            'ავთანდილ ლაბაძე',
+            'ეკა ონიანი',
+            'ბორის სოლომონია',
+            'ვახტანგ თენეიშვილი',
+        ),
+    },
+    {
+        'category': 'შემოწირულობა',
+        'subdesc': 'რეზერვის თანხა donation rule',
+        'columns': ['Original Description'],
+        'patterns': _keywords('რეზერვის თანხა'),
+    },
+    {
+        'category': 'ხელფასი',
+        'subdesc': 'კკკ salary rule',
+        'columns': ['Original Description'],
+        'patterns': _keywords('კკკ'),
+    },
+    {
+        'category': 'საკომისიო',
+        'subdesc': 'საკომის commission rule',
+        'columns': ['Original Description'],
+        'patterns': _keywords('საკომის'),
+    },
+    {
+        'category': 'რეკლამა',
+        'subdesc': 'FACEBK ads rule',
+        'columns': ['Original Description'],
+        'patterns': _keywords('FACEBK'),
+    },
+    {
+        'category': 'კონვერტაცია',
+        'subdesc': 'კონვერტაცია keyword rule',
+        'columns': ['Original Description'],
+        'patterns': _keywords('კონვერტაცია'),
+    },
+    {
+        # Server/digital service providers
+        'category': 'სერვერები',
+        'subdesc': 'Server/digital services rule',
+        'columns': ['Original Description'],
+        'patterns': _keywords(
+            'BUZZSPROUT',
+            'Mailchimp',
+            'DIGITALOCEAN.COM',
+            'Google',
+            'CLOUDFLARE',
+            'VEED',
+            '2CO.COM',
+            'WWW.VMIX.COM',
+            'TALLY.SO',
+            'ZOOM.COM',
+        ),
+    },
+    {
+        'category': 'ხელფასი',
+        'subdesc': 'საპენსიო salary rule',
+        'columns': ['Original Description'],
+        'patterns': _keywords('საპენსიო'),
+    },
+    {
+        'category': 'ხელფასი',
+        'subdesc': 'მონტაჟის საფასური salary rule',
+        'columns': ['Original Description'],
+        'patterns': _keywords('მონტაჟის საფასური'),
+    },
+    {
+        'category': 'მერჩი',
+        'subdesc': 'მერჩი keyword rule',
+        'columns': ['Original Description'],
+        'patterns': _keywords('მერჩი'),
+    },
+    {
+        'category': 'დაზღვევა',
+        'subdesc': 'დაზღვ insurance rule',
+        'columns': ['Original Description'],
+        'patterns': _keywords('დაზღვ'),
+    },
+    {
+        'category': 'შემოწირულობა',
+        'subdesc': 'mevafinansebbts donation rule',
+        'columns': ['Original Description'],
+        'patterns': _keywords('mevafinansebbts'),
+    },
+    {
+        # Utility companies in the partner name
+        'category': 'კომუნალური',
+        'subdesc': 'Utility company rule',
+        'columns': ['Partner Name'],
+        'patterns': _keywords('მაგთი', 'სილქ'),
+    },
+]
+
+
+# Lowercased copies of the columns searched by keyword rules. Computed once per
+# run so the rules can match lowercased patterns without case-folding each time.
+LOWERED_COLUMNS = {
+    'Original Description': '_desc_lc',
+    'Partner Name': '_partner_lc',
+}
+
+
+def _lowered(series):
+    """Lowercases a text column; non-string values become empty strings."""
+    if isinstance(series.dtype, pd.StringDtype):
+        return series.str.lower().fillna('')
+    return series.map(lambda value: value.lower() if isinstance(value, str) else '')
+
+
+def add_lowered_columns(df):
+    """Adds the LOWERED_COLUMNS helper columns for every searched column present in df."""
+    for col, lc_col in LOWERED_COLUMNS.items():
+        if col in df.columns:
+            df[lc_col] = _lowered(df[col])
     return df
 
 
-def apply_server_services_rule(df):
-    """
-    Apply server/digital services detection rule.
-    If any of the specified service providers appear in the transaction description,
-    it should be categorized as "სერვერები".
-    """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
-
-    # Service providers that should be categorized as "სერვერები"
-    service_keywords = [
-        'BUZZSPROUT',
-        'Mailchimp',
-        'DIGITALOCEAN.COM',
-        'Google',
-        'CLOUDFLARE',
-        'VEED',
-        '2CO.COM',
-        'WWW.VMIX.COM',
-        'TALLY.SO',
-        'ZOOM.COM'
-    ]
+def _compile_hyperscan(rule_patterns):
+    """One Hyperscan database holding every pattern, scanned once per value."""
+    expressions = [pattern.encode('utf-8') for _, pattern in rule_patterns]
+    flags = hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP | hyperscan.HS_FLAG_SINGLEMATCH
+    db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+    db.compile(
+        expressions=expressions,
+        ids=[rule_id for rule_id, _ in rule_patterns],
+        elements=len(expressions),
+        flags=[flags] * len(expressions),
+    )
 
-    # Build regex pattern for all service keywords
-    pattern = '|'.join(re.escape(keyword) for keyword in service_keywords)
+    def scan(values, no_match):
+        rule_ids = np.full(len(values), no_match, dtype=np.int32)
+        best = [no_match]
 
-    # Create mask for transactions containing any of the service keywords
-    server_mask = uncategorized_mask & df['Original Description'].str.contains(pattern, case=False, na=False)
+        def on_match(rule_id, start, end, match_flags, context):
+            if rule_id < best[0]:
+                best[0] = rule_id
 
-    # Apply the rule
-    df.loc[server_mask, 'D) Mapped Description'] = 'სერვერები'
-    df.loc[server_mask, 'E) Sub-description'] = 'Server/digital services rule'
+        for i, value in enumerate(values):
+            if not isinstance(value, str) or not value:
+                continue
+            best[0] = no_match
+            db.scan(value.encode('utf-8'), match_event_handler=on_match)
+            rule_ids[i] = best[0]
+        return rule_ids
 
-    return df
+    return scan
 
 
-def apply_sapensio_salary_rule(df):
+def _compile_re2(rule_patterns):
     """
-    Apply საპენსიო detection rule.
-    If "საპენსიო" appears in the transaction description,
-    it should be categorized as "ხელფასი".
+    One RE2 set holding every pattern. RE2 runs as an automaton in linear time
+    and reports all patterns that match, of which the lowest rule id wins.
     """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
+    pattern_set = re2.Set.SearchSet(re2.Options())
+    for _, pattern in rule_patterns:
+        pattern_set.Add(pattern)
+    pattern_set.Compile()
+    pattern_rule_ids = [rule_id for rule_id, _ in rule_patterns]
 
-    # Create mask for transactions containing "საპენსიო"
-    sapensio_mask = uncategorized_mask & df['Original Description'].str.contains('საპენსიო', case=False, na=False)
+    def scan(values, no_match):
+        rule_ids = np.full(len(values), no_match, dtype=np.int32)
+        for i, value in enumerate(values):
+            if not isinstance(value, str) or not value:
+                continue
+            matched = pattern_set.Match(value)
+            if matched:
+                rule_ids[i] = min(pattern_rule_ids[idx] for idx in matched)
+        return rule_ids
 
-    # Apply the rule
-    df.loc[sapensio_mask, 'D) Mapped Description'] = 'ხელფასი'
-    df.loc[sapensio_mask, 'E) Sub-description'] = 'საპენსიო salary rule'
-
-    return df
+    return scan
 
 
-def apply_montajis_safasuri_rule(df):
+def _compile_arrow(rule_patterns):
     """
-    Apply მონტაჟის საფასური detection rule.
-    If "მონტაჟის საფასური" appears in the transaction description,
-    it should be categorized as "ხელფასი".
+    Arrow's compute kernels: one match_substring_regex call per rule over the
+    whole Arrow array, run from the lowest priority rule to the highest so that
+    higher-priority matches overwrite lower ones.
     """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
+    by_rule = {}
+    for rule_id, pattern in rule_patterns:
+        by_rule.setdefault(rule_id, []).append(pattern)
+    rule_regexes = [(rule_id, '|'.join(by_rule[rule_id])) for rule_id in sorted(by_rule, reverse=True)]
 
-    # Create mask for transactions containing "მონტაჟის საფასური"
-    montajis_mask = uncategorized_mask & df['Original Description'].str.contains('მონტაჟის საფასური', case=False, na=False)
+    def scan(values, no_match):
+        texts = pa.array([value if isinstance(value, str) else '' for value in values], type=pa.string())
+        rule_ids = np.full(len(values), no_match, dtype=np.int32)
+        for rule_id, regex in rule_regexes:
+            matched = pc.match_substring_regex(texts, regex)
+            rule_ids[matched.to_numpy(zero_copy_only=False)] = rule_id
+        return rule_ids
 
-    # Apply the rule
-    df.loc[montajis_mask, 'D) Mapped Description'] = 'ხელფასი'
-    df.loc[montajis_mask, 'E) Sub-description'] = 'მონტაჟის საფასური salary rule'
+    return scan
 
-    return df
 
-
-def apply_merchi_keyword_rule(df):
+def _compile_regex(rule_patterns):
     """
-    Apply მერჩი keyword detection rule.
-    If "მერჩი" appears in the transaction description,
-    it should be categorized as "მერჩი".
+    Fallback without Hyperscan, RE2 or pyarrow: every rule fused into one regex,
+    run with a single str.extract. The regex is anchored at the start and each
+    rule is an alternative `(?=.*?(?P<rN>...))`; alternatives are tried in order,
+    so the first rule that matches anywhere in the text is the one captured.
     """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
+    by_rule = {}
+    for rule_id, pattern in rule_patterns:
+        by_rule.setdefault(rule_id, []).append(pattern)
+    rule_order = np.array(sorted(by_rule), dtype=np.int32)
 
-    # Create mask for transactions containing "მერჩი"
-    merchi_mask = uncategorized_mask & df['Original Description'].str.contains('მერჩი', case=False, na=False)
+    alternatives = '|'.join(
+        rf'(?=[\s\S]*?(?P<r{rule_id}>{"|".join(by_rule[rule_id])}))' for rule_id in rule_order
+    )
+    fused = re.compile(rf'\A(?:{alternatives})')
 
-    # Apply the rule
-    df.loc[merchi_mask, 'D) Mapped Description'] = 'მერჩი'
-    df.loc[merchi_mask, 'E) Sub-description'] = 'მერჩი keyword rule'
+    def scan(values, no_match):
+        extracted = pd.Series(values, dtype=object).str.extract(fused)
+        matched = extracted.notna().to_numpy(dtype=bool)
+        hit = matched.any(axis=1)
 
-    return df
+        rule_ids = np.full(len(values), no_match, dtype=np.int32)
+        rule_ids[hit] = rule_order[matched[hit].argmax(axis=1)]
+        return rule_ids
 
+    return scan
 
-def apply_dazgveva_rule(df):
-    """
-    Apply insurance detection rule.
-    If "დაზღვ" appears in the transaction description,
-    it should be categorized as "დაზღვევა".
-    """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
 
-    # Create mask for transactions containing "დაზღვ"
-    dazgveva_mask = uncategorized_mask & df['Original Description'].str.contains('დაზღვ', case=False, na=False)
+def _scan_backend():
+    """The fastest installed keyword scan backend."""
+    if hyperscan is not None:
+        return 'hyperscan'
+    if re2 is not None:
+        return 're2'
+    if pa is not None:
+        return 'arrow'
+    return 'regex'
 
-    # Apply the rule
-    df.loc[dazgveva_mask, 'D) Mapped Description'] = 'დაზღვევა'
-    df.loc[dazgveva_mask, 'E) Sub-description'] = 'დაზღვ insurance rule'
 
-    return df
+_SCAN_COMPILERS = {
+    'hyperscan': _compile_hyperscan,
+    're2': _compile_re2,
+    'arrow': _compile_arrow,
+    'regex': _compile_regex,
+}
 
 
-def apply_mevafinansebbts_rule(df):
+@functools.lru_cache(maxsize=None)
+def _rule_scanner(rule_patterns, backend):
     """
-    Apply mevafinansebbts detection rule.
-    If "mevafinansebbts" appears in the transaction description,
-    it should be categorized as "შემოწირულობა".
+    Compiles a tuple of (rule_id, pattern) pairs for `backend` once per process;
+    later calls with the same patterns reuse the compiled database/regex.
     """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
+    return _SCAN_COMPILERS[backend](rule_patterns)
 
-    # Create mask for transactions containing "mevafinansebbts"
-    mevafinansebbts_mask = uncategorized_mask & df['Original Description'].str.contains('mevafinansebbts', case=False, na=False)
 
-    # Apply the rule
-    df.loc[mevafinansebbts_mask, 'D) Mapped Description'] = 'შემოწირულობა'
-    df.loc[mevafinansebbts_mask, 'E) Sub-description'] = 'mevafinansebbts donation rule'
-
-    return df
-
-
-def apply_utility_companies_rule(df):
+def _scan_rule_ids(values, rule_patterns, no_match):
     """
-    Apply utility companies detection rule.
-    If Partner Name contains "მაგთი" or "სილქ",
-    it should be categorized as "კომუნალური".
+    `rule_patterns` is a tuple of (rule_id, pattern) pairs.
+    Returns, for each (lowercased) value, the id of the highest-priority (lowest id)
+    rule whose pattern it contains, or `no_match`.
     """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
-
-    utility_companies = ['მაგთი', 'სილქ']
-    pattern = '|'.join(re.escape(company) for company in utility_companies)
-
-    # Check Partner Name for utility companies
-    partner_name = df.get('Partner Name', pd.Series('', index=df.index)).astype(str)
-    utility_mask = uncategorized_mask & partner_name.str.contains(pattern, case=False, na=False)
-
-    # Apply the rule
-    df.loc[utility_mask, 'D) Mapped Description'] = 'კომუნალური'
-    df.loc[utility_mask, 'E) Sub-description'] = 'Utility company rule'
-
-    return df
+    return _rule_scanner(rule_patterns, _scan_backend())(values, no_match)
 
 
-def apply_gatanili_tanxa_restrictions(df):
-    """
-    Apply restrictions for "გატანილი თანხა" categorization.
-    This category can only be used for transactions to specific approved people:
-    - ვახტანგი მეგრელიშვილი
-    - ალექსანდრე რაქვიაშვილი
-    - იაგო ხვიჩია
-    - ჰერმან საბო
-    """
-    approved_names = [
-        'ვახტანგი მეგრელიშვილი',
-        'ალექსანდრე რაქვიაშვილი',
-        'იაგო ხვიჩია',
-        'ჰერმან საბო'
-    ]
-
-    # Find transactions currently categorized as "გატანილი თანხა"
-    gatanili_mask = df['D) Mapped Description'] == 'გატანილი თანხა'
+def _column_rule_patterns(rules, col):
+    """(rule_id, pattern) pairs of every rule that searches `col`."""
+    return tuple(
+        (rule_id, pattern)
+        for rule_id, rule in enumerate(rules) if col in rule['columns']
+        for pattern in rule['patterns']
+    )
 
-    # For each transaction with "გატანილი თანხა", check if it's to an approved person
-    for idx in df[gatanili_mask].index:
-        description = str(df.loc[idx, 'Original Description']).lower()
 
-        # Check if any approved name appears in the transaction description
-        name_found = any(name.lower() in description for name in approved_names)
+def keyword_rule_ids(df, rules=KEYWORD_RULES, mask_remaining=None):
+    """
+    Match all keyword categorization rules in a single pass per column.
+    Every pattern of every rule is matched at once (a Hyperscan database when
+    the library is installed, else an RE2 set, else Arrow compute kernels,
+    otherwise one fused regex).
+    Returns, per row, the index in `rules` of the first rule that matches, or
+    len(rules) for no match.
+    Matching is case-insensitive: lowercased patterns are run against the
+    LOWERED_COLUMNS copies, which are computed here if add_lowered_columns()
+    has not been called.
+    If a boolean `mask_remaining` is given, only those rows are scanned; all
+    other rows get len(rules).
+    """
+    no_match = len(rules)
+    rule_ids = np.full(len(df), no_match, dtype=np.int32)
+    if mask_remaining is None:
+        mask_remaining = np.ones(len(df), dtype=bool)
+    if not mask_remaining.any():
+        return rule_ids
+    remaining_ids = rule_ids[mask_remaining]
+
+    columns = dict.fromkeys(col for rule in rules for col in rule['columns'])
+    for col in columns:
+        if col not in df.columns:
+            continue
+        rule_patterns = _column_rule_patterns(rules, col)
+        lc_col = LOWERED_COLUMNS.get(col)
+        if lc_col in df.columns:
+            lowered = df[lc_col][mask_remaining]
+        else:
+            lowered = _lowered(df[col][mask_remaining])
+        # Descriptions repeat heavily (recurring donors, salaries), so only
+        # the distinct values are scanned and the result is broadcast back
+        codes, uniques = pd.factorize(lowered.to_numpy(dtype=object))
+        unique_ids = _scan_rule_ids(np.asarray(uniques, dtype=object), rule_patterns, no_match)
+        remaining_ids = np.minimum(remaining_ids, unique_ids[codes])
+
+    rule_ids[mask_remaining] = remaining_ids
+    return rule_ids
+
+
+# Compile the scanners of the default rules once, at import
+for _col in dict.fromkeys(col for rule in KEYWORD_RULES for col in rule['columns']):
+    _rule_scanner(_column_rule_patterns(KEYWORD_RULES, _col), _scan_backend())
+
+
+def apply_pre_ai_rules(df, internal_accounts_list, rules=KEYWORD_RULES):
+    """
+    Apply all rule-based categorization before AI, in priority order: internal
+    transfers, the BT-specific rules, then the keyword `rules`. Every rule only
+    contributes a (mask, category, subdesc) predicate; they are coalesced with
+    one np.select into staging arrays, so each still-uncategorized transaction
+    gets the first rule that matches it and each category column is replaced
+    in a single assignment instead of repeated df.loc writes.
+    """
+    # Start from the existing values; only uncategorized transactions take a rule's result
+    cat_out = np.full(len(df), None, dtype=object)
+    sub_out = np.full(len(df), None, dtype=object)
+    if 'D) Mapped Description' in df.columns:
+        cat_out[:] = df['D) Mapped Description'].to_numpy(dtype=object)
+    if 'E) Sub-description' in df.columns:
+        sub_out[:] = df['E) Sub-description'].to_numpy(dtype=object)
+    uncategorized = pd.isna(cat_out)
+
+    plan = internal_transfer_rule_masks(df, internal_accounts_list)
+    plan.extend(bt_specific_rule_masks(df))
+
+    # The keyword scan only needs rows that no earlier rule has claimed
+    mask_remaining = uncategorized.copy()
+    for mask, _, _ in plan:
+        mask_remaining &= ~mask
+
+    # Keyword rules collapse into one predicate; the row's rule id picks its category
+    rule_ids = keyword_rule_ids(df, rules, mask_remaining=mask_remaining)
+    categories = np.array([rule['category'] for rule in rules] + [None], dtype=object)
+    subdescs = np.array([rule['subdesc'] for rule in rules] + [None], dtype=object)
+    plan.append((rule_ids < len(rules), categories[rule_ids], subdescs[rule_ids]))
+
+    conditions = [mask for mask, _, _ in plan]
+    category = np.select(conditions, [cat for _, cat, _ in plan], default=None)
+    subdesc = np.select(conditions, [sub for _, _, sub in plan], default=None)
+
+    hit = uncategorized & np.logical_or.reduce(conditions)
+    cat_out[hit] = category[hit]
+    sub_out[hit] = subdesc[hit]
 
-        # If no approved name found, change category to "სხვა"
-        if not name_found:
-            df.loc[idx, 'D) Mapped Description'] = 'სხვა'
-            df.loc[idx, 'E) Sub-description'] = 'გატანილი თანხა restriction applied'
+    # Apply the rules
+    df['D) Mapped Description'] = cat_out
+    df['E) Sub-description'] = sub_out
 
     return df
 
 
-def map_internal_transfers(df, internal_accounts_list):
-    """
-    Maps internal transfers and automatically categorizes them as კონვერტაცია.
-    This function now detects when both source and destination accounts are internal
-    and sets the category to კონვერტაცია without requiring AI categorization.
-    """
-    # Ensure Partner Account and Source Account are strings
-    df['Partner Account'] = df['Partner Account'].astype(str)
-    df['Source Account'] = df['Source Account'].astype(str) if 'Source Account' in df.columns else ''
-
-    # Mark Partner Account as Internal or External
-    df['AD) Partner Account Internal Map'] = df['Partner Account'].apply(
-        lambda x: 'Internal Transfer' if x in internal_accounts_list else 'External'
-    )
-
-    # Detect internal-to-internal transfers and categorize as კონვერტაცია
-    internal_transfer_mask = (
-        df['Source Account'].isin(internal_accounts_list) &
-        df['Partner Account'].isin(internal_accounts_list) &
-        (df['Partner Account'] != 'nan') &  # Exclude NaN values converted to string
-        (df['Partner Account'] != '') &     # Exclude empty strings
-        (df['Source Account'] != df['Partner Account'])  # Exclude same account transfers
-    )
-
-    # Apply კონვერტაცია categorization for internal transfers
-    df.loc[internal_transfer_mask, 'D) Mapped Description'] = 'კონვერტაცია'
-    df.loc[internal_transfer_mask, 'E) Sub-description'] = 'Internal account transfer'
-
-    return df
+# Every category the pipeline can assign: AI categories, rule categories and the AI failure fallback
+OUTPUT_CATEGORIES = list(dict.fromkeys(
+    config.ALLOWED_CATEGORIES
+    + [rule['category'] for rule in KEYWORD_RULES]
+    + ['Uncategorized']
+))
 
 
-def apply_specific_people_gatanili_rule(df):
+def to_categorical_columns(df):
     """
-    If either the original description or partner name contains any of
-    the specified Georgian names, force-map the category to "გატანილი თანხა".
-
-    Names checked:
-    - რაქვიაშვილი
-    - მეგრელიშვილი
-    - ჰერმან
-    - იაგო ხვიჩია
-    - ნარტყოშვილი
+    Stores the low-cardinality label columns as pandas Categorical (one integer
+    code per row instead of a Python string). Call after the last rule that
+    writes these columns. Unexpected categories are appended rather than lost.
     """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
-
-    target_names = ['რაქვიაშვილი', 'მეგრელიშვილი', 'ჰერმან', 'იაგო ხვიჩია', 'ნარტყოშვილი']
-    # Build a regex pattern that matches any of the names
-    pattern = '|'.join(re.escape(name) for name in target_names)
-
-    # Prepare safe series for checks
-    orig_desc = df.get('Original Description', pd.Series('', index=df.index)).astype(str)
-    partner_name = df.get('Partner Name', pd.Series('', index=df.index)).astype(str)
-
-    mask = uncategorized_mask & (
-        orig_desc.str.contains(pattern, case=False, na=False) |
-        partner_name.str.contains(pattern, case=False, na=False)
-    )
-
-    df.loc[mask, 'D) Mapped Description'] = 'გატანილი თანხა'
-    df.loc[mask, 'E) Sub-description'] = 'Name-based mapping rule'
-
-    return df
-
-
-def apply_salary_name_mapping_rule(df):
-    """
-    If Original Description OR Partner Name contains any of the specified names,
-    force-map the category to "ხელფასი".
-
-    Names checked:
-    ლევან ჯგერენაია,
-    ნუგზარ ტაბატაძე,
-    რევაზი სუთიძე,
-    მაყვალა გიორგაძე,
-    იზა ნადარეიშვილი,
-    მარიკა ვერულიძე,
-    ლიზი შეწირული,
-    გიორგი პაჭიკაშვილი,
-    ვაკო თენეიშვილი,
-    თედო ჯაბუა,
-    ანა ნოდია,
-    გიორგი სოლოღაშვილი,
-    რუსუდანი აბუაშვილი,
-    სიმონ ღარიბაშვილი,
-    ავთანდილ ლაბაძე,
-    ეკა ონიანი,
-    ბორის სოლომონია,
-    ვახტანგ თენეიშვილი
-    """
-    # Only apply to uncategorized transactions
-    uncategorized_mask = ~df.get('D) Mapped Description', pd.Series(dtype=bool)).notna()
-
-    names = [
-        'ლევან ჯგერენაია',
-        'ნუგზარ ტაბატაძე',
-        'რევაზი სუთიძე',
-        'მაყვალა გიორგაძე',
-        'იზა ნადარეიშვილი',
-        'მარიკა ვერულიძე',
-        'ლიზი შეწირული',
-        'გიორგი პაჭიკაშვილი',
-        'ვაკო თენეიშვილი',
-        'თედო ჯაბუა',
-        'ანა ნოდია',
-        'გიორგი სოლოღაშვილი',
-        'რუსუდანი აბუაშვილი',
-        'სიმონ ღარიბაშვილი',
-        'ავთანდილ ლაბაძე',
-        'ეკა ონიანი',
-        'ბორის სოლომონია',
-        'ვახტანგ თენეიშვილი',
-    ]
-
-    pattern = '|'.join(re.escape(n) for n in names)
-    desc = df.get('Original Description', pd.Series('', index=df.index)).astype(str)
-    partner_name = df.get('Partner Name', pd.Series('', index=df.index)).astype(str)
-
-    # Check both Original Description AND Partner Name
-    mask = uncategorized_mask & (
-        desc.str.contains(pattern, case=False, na=False) |
-        partner_name.str.contains(pattern, case=False, na=False)
-    )
-
-    df.loc[mask, 'D) Mapped Description'] = 'ხელფასი'
-    df.loc[mask, 'E) Sub-description'] = 'Salary name mapping rule'
-
+    if 'D) Mapped Description' in df.columns:
+        observed = df['D) Mapped Description'].dropna().unique().tolist()
+        df['D) Mapped Description'] = pd.Categorical(
+            df['D) Mapped Description'],
+            categories=list(dict.fromkeys(OUTPUT_CATEGORIES + observed)),
+        )
+    for col in ['E) Sub-description', 'Source File', 'AD) Partner Account Internal Map']:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
     return df
@@ -1,7 +1,34 @@
 # process_files.py
+import functools
+import numpy as np
 import pandas as pd
 import os
 
+try:
+    import pyarrow  # noqa: F401  Optional: Arrow-backed string columns
+    STRING_DTYPE = 'string[pyarrow]'
+except ImportError:
+    STRING_DTYPE = 'string'
+
+try:
+    import python_calamine  # noqa: F401  Optional: Rust-based Excel reader
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = None  # pandas default (openpyxl)
+
+try:
+    import xlsxwriter  # Optional: streaming Excel writer
+except ImportError:
+    xlsxwriter = None
+
+# Files whose partner names are read from fixed columns (see process_statement)
+TBC_PARTNER_NAME_FILES = ['BT TBC GEL', 'GIRCHI TBC GEL', 'GIRCHI TBC USD']
+BOG_PARTNER_NAME_FILES = ['TV36 BOG', 'BT BOG']
+
+# Text columns stored with the string dtype (see to_string_dtype)
+TEXT_COLUMNS = ['Original Description', 'Partner Name', 'Partner Account', 'Source File']
+
+@functools.lru_cache(maxsize=1024)
 def excel_col_to_int(col_str):
     """Converts Excel column letters (A, B, AA, etc.) to a zero-based integer index."""
     num = 0
@@ -9,6 +36,53 @@ def excel_col_to_int(col_str):
         num = num * 26 + (ord(c.upper()) - ord('A')) + 1
     return num - 1
 
+# {file key: letter -> zero-based index map}, filled by column_index_map()
+_COLUMN_INDEX_MAPS = {}
+
+def column_index_map(config, file_key):
+    """
+    Returns {letter: zero-based index} for every column a file config reads:
+    its column map, the conditional partner account columns and the partner
+    name columns of its bank (see process_statement).
+    Computed once per file key and reused for later statements of that file.
+    """
+    if file_key in _COLUMN_INDEX_MAPS:
+        return _COLUMN_INDEX_MAPS[file_key]
+    used_letters = set(config['column_map'])
+    if 'conditional_partner_account' in config:
+        conditional_config = config['conditional_partner_account']
+        used_letters.update([
+            conditional_config['condition_column'],
+            conditional_config['if_has_content'],
+            conditional_config['if_empty'],
+        ])
+    if file_key in TBC_PARTNER_NAME_FILES:
+        used_letters.add('K')
+    elif file_key in BOG_PARTNER_NAME_FILES:
+        used_letters.update(['D', 'E', 'J', 'O'])
+    _COLUMN_INDEX_MAPS[file_key] = {letter: excel_col_to_int(letter) for letter in used_letters}
+    return _COLUMN_INDEX_MAPS[file_key]
+
+def _column_values(df, col_index):
+    """The sheet column at `col_index` as an object array; all None if the sheet lacks it."""
+    if col_index in df.columns:
+        return df[col_index].to_numpy(dtype=object)
+    return np.full(len(df), None, dtype=object)
+
+def _column_numbers(df, col_index):
+    """The sheet column at `col_index` as floats (non-numeric and missing values are 0)."""
+    if col_index in df.columns:
+        return pd.to_numeric(df[col_index], errors='coerce').fillna(0).to_numpy(dtype=float)
+    return np.zeros(len(df))
+
+def to_string_dtype(df, columns):
+    """
+    Converts the given text columns to the pandas string dtype (Arrow-backed when
+    pyarrow is installed), so .str operations run on contiguous UTF-8 buffers
+    instead of Python objects. Missing columns are skipped.
+    """
+    return df.astype({col: STRING_DTYPE for col in columns if col in df.columns})
+
 def process_statement(filepath, config):
     """
     Reads a specific sheet and start row from an Excel file,
@@ -17,7 +91,17 @@ def process_statement(filepath, config):
     sheet_name = config['sheet_name']
     start_row = config['start_row']
     column_map = config['column_map']
-    
+
+    source_filename = os.path.basename(filepath)
+    file_key = os.path.splitext(source_filename)[0]
+
+    # Only materialize the columns this file actually uses. Columns keep their
+    # sheet position as label; a callable (unlike "A,B,...") tolerates letters
+    # beyond the sheet's last column, which are then simply absent.
+    col_index = column_index_map(config, file_key)
+    used_indices = set(col_index.values())
+    usecols = lambda col: col in used_indices
+
     # Read the specific sheet, skip the top rows, and treat the first row of data as having no header.
     # The 'skiprows' parameter is zero-indexed, so we subtract 1.
     try:
@@ -25,7 +109,9 @@ def process_statement(filepath, config):
             filepath,
             sheet_name=sheet_name,
             skiprows=start_row - 1,
-            header=None
+            header=None,
+            usecols=usecols,
+            engine=EXCEL_ENGINE
         )
     except Exception as e:
         # Fallback: some BOG files may have sheet name "Statement of Account"
@@ -34,7 +120,9 @@ def process_statement(filepath, config):
                 filepath,
                 sheet_name='Statement of Account',
                 skiprows=start_row - 1,
-                header=None
+                header=None,
+                usecols=usecols,
+                engine=EXCEL_ENGINE
             )
         except Exception:
             # Re-raise original exception to preserve the fail-fast behavior
@@ -45,9 +133,8 @@ def process_statement(filepath, config):
 
     # Map the data using column letters
     for col_letter, target_name in column_map.items():
-        col_index = excel_col_to_int(col_letter)
-        if col_index < len(df.columns):
-            processed_df[target_name] = df.iloc[:, col_index]
+        if col_index[col_letter] in df.columns:
+            processed_df[target_name] = df[col_index[col_letter]]
         else:
             # If a column doesn't exist (e.g., no 'Balance' column), create an empty one
             processed_df[target_name] = None
@@ -59,83 +146,57 @@ def process_statement(filepath, config):
         col_if_content = conditional_config['if_has_content']
         col_if_empty = conditional_config['if_empty']
         
-        # Get the condition column data
-        condition_col_index = excel_col_to_int(condition_col)
-        if condition_col_index < len(df.columns):
-            condition_data = df.iloc[:, condition_col_index]
-        else:
-            condition_data = pd.Series([None] * len(df))
-        
-        # Get data from both potential partner account columns
-        col_content_index = excel_col_to_int(col_if_content)
-        col_empty_index = excel_col_to_int(col_if_empty)
-        
-        partner_data_content = df.iloc[:, col_content_index] if col_content_index < len(df.columns) else pd.Series([None] * len(df))
-        partner_data_empty = df.iloc[:, col_empty_index] if col_empty_index < len(df.columns) else pd.Series([None] * len(df))
-        
-        # Create Partner Account column based on condition
-        partner_account = []
-        for i, condition_value in enumerate(condition_data):
-            # Check if condition column has content (not null, not empty string, not 0)
+        # Condition column has content: not null, not an empty string, not 0
+        condition_col_index = col_index[condition_col]
+        if condition_col_index in df.columns:
+            condition_data = df[condition_col_index]
             has_content = (
-                pd.notna(condition_value) and 
-                str(condition_value).strip() != '' and 
-                condition_value != 0
+                condition_data.notna().to_numpy(dtype=bool) &
+                (condition_data.astype(str).str.strip() != '').to_numpy(dtype=bool, na_value=True) &
+                (condition_data.to_numpy(dtype=object) != 0)
             )
-            
-            if has_content:
-                # Use column L if E has content
-                partner_account.append(partner_data_content.iloc[i] if i < len(partner_data_content) else None)
-            else:
-                # Use column Q if E is empty
-                partner_account.append(partner_data_empty.iloc[i] if i < len(partner_data_empty) else None)
-        
-        processed_df['Partner Account'] = partner_account
+        else:
+            has_content = np.zeros(len(df), dtype=bool)
+
+        # Get data from both potential partner account columns
+        partner_data_content = _column_values(df, col_index[col_if_content])
+        partner_data_empty = _column_values(df, col_index[col_if_empty])
+
+        # Use column L if E has content, column Q if E is empty
+        processed_df['Partner Account'] = pd.Series(
+            np.where(has_content, partner_data_content, partner_data_empty),
+            index=df.index,
+        ).infer_objects()
     
     # Extract partner names based on file type and rules
-    source_filename = os.path.basename(filepath)
-    file_key = os.path.splitext(source_filename)[0]
-    
     # For TBC files (BT TBC GEL, GIRCHI TBC GEL, GIRCHI TBC USD), extract from column K
-    if file_key in ['BT TBC GEL', 'GIRCHI TBC GEL', 'GIRCHI TBC USD']:
-        partner_name_col_index = excel_col_to_int('K')
-        if partner_name_col_index < len(df.columns):
-            processed_df['Partner Name'] = df.iloc[:, partner_name_col_index]
+    if file_key in TBC_PARTNER_NAME_FILES:
+        partner_name_col_index = col_index['K']
+        if partner_name_col_index in df.columns:
+            processed_df['Partner Name'] = df[partner_name_col_index]
         else:
             processed_df['Partner Name'] = None
     
     # For BOG files (TV36 BOG, BT BOG), use conditional logic for partner names
-    elif file_key in ['TV36 BOG', 'BT BOG']:
+    elif file_key in BOG_PARTNER_NAME_FILES:
         # Get column data for conditions and partner names
-        col_e_index = excel_col_to_int('E')
-        col_d_index = excel_col_to_int('D')
-        col_j_index = excel_col_to_int('J')
-        col_o_index = excel_col_to_int('O')
-        
-        col_e_data = df.iloc[:, col_e_index] if col_e_index < len(df.columns) else pd.Series([0] * len(df))
-        col_d_data = df.iloc[:, col_d_index] if col_d_index < len(df.columns) else pd.Series([0] * len(df))
-        col_j_data = df.iloc[:, col_j_index] if col_j_index < len(df.columns) else pd.Series([None] * len(df))
-        col_o_data = df.iloc[:, col_o_index] if col_o_index < len(df.columns) else pd.Series([None] * len(df))
-        
-        # Create Partner Name column based on conditional logic
-        partner_names = []
-        for i in range(len(df)):
-            col_e_val = pd.to_numeric(col_e_data.iloc[i], errors='coerce') if i < len(col_e_data) else 0
-            col_d_val = pd.to_numeric(col_d_data.iloc[i], errors='coerce') if i < len(col_d_data) else 0
-            
-            # Default to None
-            partner_name = None
-            
-            # If column E > 0, use column J for partner name
-            if pd.notna(col_e_val) and col_e_val > 0:
-                partner_name = col_j_data.iloc[i] if i < len(col_j_data) else None
-            # If column D > 0, use column O for partner name
-            elif pd.notna(col_d_val) and col_d_val > 0:
-                partner_name = col_o_data.iloc[i] if i < len(col_o_data) else None
-            
-            partner_names.append(partner_name)
+        col_e_index = col_index['E']
+        col_d_index = col_index['D']
+        col_j_index = col_index['J']
+        col_o_index = col_index['O']
         
-        processed_df['Partner Name'] = partner_names
+        col_e_val = _column_numbers(df, col_e_index)
+        col_d_val = _column_numbers(df, col_d_index)
+
+        # If column E > 0, use column J for partner name; else if column D > 0, use column O; default None
+        processed_df['Partner Name'] = pd.Series(
+            np.where(
+                col_e_val > 0,
+                _column_values(df, col_j_index),
+                np.where(col_d_val > 0, _column_values(df, col_o_index), None),
+            ),
+            index=df.index,
+        ).infer_objects()
     
     else:
         # For other files, no partner name extraction
@@ -158,4 +219,35 @@ def process_statement(filepath, config):
         if col in processed_df.columns:
             processed_df[col] = pd.to_numeric(processed_df[col], errors='coerce').fillna(0)
 
+    # Arrow-backed text columns: the keyword rules' .str operations run on them directly
+    processed_df = to_string_dtype(processed_df, TEXT_COLUMNS)
+
     return processed_df
+
+def write_excel(df, output_path):
+    """
+    Writes df to an .xlsx file without the index.
+    With xlsxwriter installed, rows are streamed in constant_memory mode, so each
+    row is flushed to disk as soon as it is written instead of holding the whole
+    workbook in memory. pandas' to_excel emits cells column by column, which
+    constant_memory cannot handle, hence the row-wise writer.
+    """
+    if xlsxwriter is None:
+        df.to_excel(output_path, index=False)
+        return
+
+    workbook = xlsxwriter.Workbook(output_path, {
+        'constant_memory': True,
+        'default_date_format': 'yyyy-mm-dd',
+        'nan_inf_to_errors': True,
+    })
+    worksheet = workbook.add_worksheet('Sheet1')
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+
+    # Missing values (NaN, None, pd.NA, NaT) become empty cells, like to_excel. They are
+    # replaced row by row so no object copy of the whole frame is built.
+    for row_idx, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_idx, 0, [None if pd.isna(value) else value for value in row])
+
+    workbook.close()